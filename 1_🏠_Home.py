@@ -8,7 +8,7 @@ import streamlit as st
 import folium
 import leafmap.foliumap as leafmap
 import pandas as pd
-from utils import hydrology_explorer
+from utils import hydrology_explorer, prefetch
 
 # Set page title icons and options for layout
 st.set_page_config(page_title="Home", page_icon="🏠", layout="wide")
@@ -84,6 +84,10 @@ def get_stations(start_date: str, end_date: str, property: str) -> pd.DataFrame:
     df_level_stations.rename({"@id": "id", "long": "lon"}, axis="columns", inplace=True)
     return df_level_stations
 
+@st.cache_resource
+def get_prefetch_pool():
+    return prefetch.create_pool()
+
 def update_station(selected_option):
   st.session_state["station_name"] = selected_option
 
@@ -124,6 +128,13 @@ for col in [
         df_level_stations[col] = replace_list_values(df_level_stations[col])
 
         # df_level_stations[col] = df_level_stations[col].astype(float)
+
+if "prefetcher" not in st.session_state:
+    st.session_state["prefetcher"] = prefetch.StationPrefetcher(get_prefetch_pool())
+
+# start fetching measures and nearby rain gauges while the page renders
+st.session_state["prefetcher"].select(df_level_stations, station_name)
+
 df_level_stations_display = df_level_stations[
     [
         "label",
@@ -149,8 +160,8 @@ station_easting = df_level_stations[df_level_stations["label"] == station_name][
 station_northing = df_level_stations[df_level_stations["label"] == station_name]["northing"].values[0]
 
 #get all rainfall sites within 8km 
-df_rainfall_sites = hydrology_explorer.get_rainfall(
-    station_easting, station_northing, 8000  
+df_rainfall_sites = st.session_state["prefetcher"].get_rainfall(
+    station_easting, station_northing
 )
 st.session_state['df_rainfall_sites'] = df_rainfall_sites
 
@@ -0,0 +1,368 @@
+import json
+import math
+import os
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from typing import Any, Callable, Dict, List, Optional, Tuple
+
+import numpy as np
+import pandas as pd
+
+from utils.feature_cache import FeatureCache
+
+# Hyperparameter search for the river level models.
+#
+# Configurations are drawn at random from a search space and compared with
+# Hyperband: several rounds of successive halving, each starting a different
+# number of configurations on a different number of time-series CV folds.
+# Every configuration is first scored on the most recent fold(s) and only the
+# best 1 / eta of them are scored on more folds, so poor configurations stop
+# early. Fold scores run on a process pool; workers map the training matrix
+# from the FeatureCache instead of receiving a copy, and every score is
+# appended to a checkpoint file so an interrupted search can resume.
+#
+# A search space maps parameter names to one of:
+#   ("uniform", low, high)
+#   ("loguniform", low, high)
+#   ("int", low, high)        high is included
+#   ("choice", [option, ...])
+
+# feature matrices already mapped by this (worker) process
+_features: Dict[Tuple[str, str], pd.DataFrame] = {}
+
+
+def sample_params(space: Dict[str, tuple], rng: np.random.Generator) -> Dict[str, Any]:
+    """
+    Draw one configuration from a search space.
+
+    Args:
+        space: The search space, see the module comment.
+        rng: The random number generator to draw from.
+
+    Returns:
+        A dictionary of parameter values.
+
+    Raises:
+        ValueError: If a parameter has an unknown distribution.
+    """
+    params = {}
+    for name, spec in space.items():
+        kind = spec[0]
+        if kind == "uniform":
+            params[name] = float(rng.uniform(spec[1], spec[2]))
+        elif kind == "loguniform":
+            params[name] = float(np.exp(rng.uniform(np.log(spec[1]), np.log(spec[2]))))
+        elif kind == "int":
+            params[name] = int(rng.integers(spec[1], spec[2] + 1))
+        elif kind == "choice":
+            params[name] = spec[1][int(rng.integers(len(spec[1])))]
+        else:
+            raise ValueError(f"Unknown distribution {kind!r} for {name}")
+    return params
+
+
+def time_series_folds(n_samples: int, n_folds: int,
+                      gap: int = 0) -> List[Tuple[slice, slice]]:
+    """
+    Split a time-ordered series into expanding-window CV folds.
+
+    The series is cut into n_folds + 1 equal blocks. Fold i trains on
+    blocks 0 to i and tests on block i + 1, so the last fold is the most
+    recent.
+
+    Args:
+        n_samples: The number of rows in the feature matrix.
+        n_folds: The number of folds.
+        gap: Rows dropped between each training and test set, to stop lagged
+            features leaking the test period into training.
+
+    Returns:
+        A list of (train, test) slices, oldest first.
+    """
+    bounds = np.linspace(0, n_samples, n_folds + 2).astype(int).tolist()
+    return [
+        (slice(0, max(bounds[i + 1] - gap, 0)), slice(bounds[i + 1], bounds[i + 2]))
+        for i in range(n_folds)
+    ]
+
+
+def rmse(y_true: np.ndarray, y_pred: np.ndarray) -> float:
+    """Root mean squared error, the default score (lower is better)."""
+    return float(np.sqrt(np.mean((np.asarray(y_true) - np.asarray(y_pred)) ** 2)))
+
+
+def hyperband(
+    make_model: Callable[[Dict[str, Any]], Any],
+    space: Dict[str, tuple],
+    cache_root: str,
+    features_key: str,
+    target: str,
+    n_folds: int = 9,
+    eta: int = 3,
+    n_configs: Optional[int] = None,
+    gap: int = 0,
+    score: Callable[[np.ndarray, np.ndarray], float] = rmse,
+    max_workers: Optional[int] = None,
+    checkpoint: Optional[str] = None,
+    seed: int = 0,
+) -> pd.DataFrame:
+    """
+    Tune a model with Hyperband over time-series CV folds.
+
+    Args:
+        make_model: A function returning an unfitted model with fit(X, y)
+            and predict(X) for a dictionary of parameters. It must be defined
+            at module level so it can be sent to worker processes.
+        space: The search space, see the module comment.
+        cache_root: The FeatureCache directory holding the feature matrix.
+        features_key: The cache key of the feature matrix.
+        target: The column of the feature matrix to predict; all other
+            columns are used as features.
+        n_folds: The number of CV folds, i.e. the largest budget a
+            configuration can be given.
+        eta: The halving rate. Only the best 1 / eta of the configurations in
+            each round go on to eta times as many folds.
+        n_configs: How many configurations the most exploratory round
+            starts with. Defaults to the standard eta ** s_max.
+        gap: Rows dropped between training and test sets.
+        score: A function of (y_true, y_pred); lower is better.
+        max_workers: The number of worker processes. Defaults to the number
+            of CPUs.
+        checkpoint: A file to append fold scores to. Scores already in the
+            file are reused, so rerunning with the same arguments resumes an
+            interrupted search.
+        seed: The seed for drawing configurations.
+
+    Returns:
+        A Pandas DataFrame with one row per configuration: its parameters,
+        the number of folds it was scored on and its mean score, best first.
+    """
+    s_max = int(math.floor(math.log(n_folds) / math.log(eta) + 1e-9))
+    if n_configs is None:
+        n_configs = eta ** s_max
+    rng = np.random.default_rng(seed)
+
+    trials: Dict[str, Dict[str, Any]] = {}
+    results: Dict[str, float] = {}
+    with _Evaluator(make_model, cache_root, features_key, target, n_folds,
+                    gap, score, max_workers, checkpoint) as evaluator:
+        for s in range(s_max, -1, -1):
+            n = int(math.ceil(n_configs * (s_max + 1) / (s + 1) / eta ** (s_max - s)))
+            bracket = {
+                f"{s}-{i}": sample_params(space, rng) for i in range(n)
+            }
+            trials.update(bracket)
+            results.update(
+                _successive_halving(evaluator, bracket, n_folds // eta ** s, eta)
+            )
+
+        rows = []
+        for trial_id, params in trials.items():
+            folds_done = evaluator.folds_done(trial_id)
+            rows.append({
+                "trial": trial_id,
+                **params,
+                "folds": folds_done,
+                "score": results.get(trial_id, np.nan),
+            })
+    return pd.DataFrame(rows).sort_values(["folds", "score"], ascending=[False, True],
+                                          ignore_index=True)
+
+
+def successive_halving(
+    make_model: Callable[[Dict[str, Any]], Any],
+    space: Dict[str, tuple],
+    cache_root: str,
+    features_key: str,
+    target: str,
+    n_configs: int = 27,
+    n_folds: int = 9,
+    min_folds: int = 1,
+    eta: int = 3,
+    gap: int = 0,
+    score: Callable[[np.ndarray, np.ndarray], float] = rmse,
+    max_workers: Optional[int] = None,
+    checkpoint: Optional[str] = None,
+    seed: int = 0,
+) -> pd.DataFrame:
+    """
+    Tune a model with a single round of successive halving.
+
+    Arguments are as for hyperband, plus:
+
+    Args:
+        n_configs: The number of configurations to start with.
+        min_folds: The number of folds every configuration is scored on.
+
+    Returns:
+        A Pandas DataFrame with one row per configuration, best first.
+    """
+    rng = np.random.default_rng(seed)
+    trials = {f"sh-{i}": sample_params(space, rng) for i in range(n_configs)}
+    with _Evaluator(make_model, cache_root, features_key, target, n_folds,
+                    gap, score, max_workers, checkpoint) as evaluator:
+        results = _successive_halving(evaluator, trials, min_folds, eta)
+        rows = [
+            {"trial": trial_id, **params, "folds": evaluator.folds_done(trial_id),
+             "score": results[trial_id]}
+            for trial_id, params in trials.items()
+        ]
+    return pd.DataFrame(rows).sort_values(["folds", "score"], ascending=[False, True],
+                                          ignore_index=True)
+
+
+def _successive_halving(evaluator: "_Evaluator", trials: Dict[str, Dict[str, Any]],
+                        min_folds: int, eta: int) -> Dict[str, float]:
+    # Score every trial on the most recent min_folds folds, keep the best
+    # 1 / eta, give them eta times as many folds and repeat until the
+    # survivors have been scored on every fold.
+    results: Dict[str, float] = {}
+    survivors = dict(trials)
+    n_used = max(min_folds, 1)
+    while True:
+        n_used = min(n_used, evaluator.n_folds)
+        folds = list(range(evaluator.n_folds - n_used, evaluator.n_folds))
+        results.update(evaluator.evaluate(survivors, folds))
+        if n_used == evaluator.n_folds or len(survivors) <= 1:
+            return results
+        n_keep = max(len(survivors) // eta, 1)
+        ranked = sorted(survivors, key=lambda trial_id: results[trial_id])
+        survivors = {trial_id: survivors[trial_id] for trial_id in ranked[:n_keep]}
+        n_used *= eta
+
+
+class _Evaluator:
+    # Scores (trial, fold) pairs on a process pool, remembering every score
+    # and appending it to the checkpoint file.
+    #
+    # The first line of a checkpoint is a fingerprint of everything that
+    # decides what a fold score means (data, target, fold boundaries and
+    # score function). Resuming from a checkpoint with a different
+    # fingerprint is refused, and a record is only reused when its trial
+    # parameters match too.
+
+    def __init__(self, make_model, cache_root, features_key, target, n_folds,
+                 gap, score, max_workers, checkpoint):
+        self.make_model = make_model
+        self.cache_root = cache_root
+        self.features_key = features_key
+        self.target = target
+        self.n_folds = n_folds
+        self.gap = gap
+        self.score = score
+        self.max_workers = max_workers
+        self.checkpoint = checkpoint
+        self.scores: Dict[Tuple[str, int], Tuple[Dict[str, Any], float]] = {}
+        # scores that belong to this run, reused or newly computed
+        self.used: Dict[Tuple[str, int], float] = {}
+        self.fingerprint = {
+            "features_key": features_key,
+            "target": target,
+            "n_folds": n_folds,
+            "gap": gap,
+            "score": f"{getattr(score, '__module__', '')}.{getattr(score, '__qualname__', repr(score))}",
+        }
+
+    def __enter__(self):
+        if self.checkpoint and os.path.exists(self.checkpoint) \
+                and os.path.getsize(self.checkpoint) > 0:
+            with open(self.checkpoint) as f:
+                try:
+                    header = json.loads(f.readline())
+                except ValueError:
+                    header = None
+                if not isinstance(header, dict) or header.get("fingerprint") != self.fingerprint:
+                    raise ValueError(
+                        f"Checkpoint {self.checkpoint} was written by a search with "
+                        f"different data, folds or score; use a new checkpoint file"
+                    )
+                for line in f:
+                    try:
+                        record = json.loads(line)
+                    except ValueError:
+                        continue  # a line cut short when the search was stopped
+                    self.scores[(record["trial"], record["fold"])] = (
+                        record["params"], record["score"]
+                    )
+        elif self.checkpoint:
+            with open(self.checkpoint, "w") as f:
+                f.write(json.dumps({"fingerprint": self.fingerprint}) + "\n")
+        self.pool = ProcessPoolExecutor(max_workers=self.max_workers)
+        return self
+
+    def __exit__(self, *exc_info):
+        self.pool.shutdown(cancel_futures=True)
+
+    def folds_done(self, trial_id: str) -> int:
+        return sum(1 for (trial, _) in self.used if trial == trial_id)
+
+    def evaluate(self, trials: Dict[str, Dict[str, Any]],
+                 folds: List[int]) -> Dict[str, float]:
+        futures = {}
+        for trial_id, params in trials.items():
+            for fold in folds:
+                done = self.scores.get((trial_id, fold))
+                # a trial id drawn with a different seed or space is rescored
+                if done is not None and done[0] == _jsonable(params):
+                    self.used[(trial_id, fold)] = done[1]
+                    continue
+                future = self.pool.submit(
+                    _score_fold, self.make_model, params, self.cache_root,
+                    self.features_key, self.target, fold, self.n_folds,
+                    self.gap, self.score,
+                )
+                futures[future] = (trial_id, params, fold)
+
+        for future in as_completed(futures):
+            trial_id, params, fold = futures[future]
+            fold_score = future.result()
+            self.scores[(trial_id, fold)] = (_jsonable(params), fold_score)
+            self.used[(trial_id, fold)] = fold_score
+            if self.checkpoint:
+                with open(self.checkpoint, "a") as f:
+                    f.write(json.dumps({
+                        "trial": trial_id, "params": params,
+                        "fold": fold, "score": fold_score,
+                    }) + "\n")
+
+        return {
+            trial_id: float(np.mean([self.used[(trial_id, fold)] for fold in folds]))
+            for trial_id in trials
+        }
+
+
+def _jsonable(params: Dict[str, Any]) -> Dict[str, Any]:
+    return json.loads(json.dumps(params))
+
+
+def _score_fold(make_model, params, cache_root, features_key, target, fold,
+                n_folds, gap, score) -> float:
+    # Runs in a worker process. The feature matrix is memory-mapped once per
+    # process and shared by every fold the process scores.
+    cache_id = (cache_root, features_key)
+    if cache_id not in _features:
+        df_features = FeatureCache(cache_root).load(features_key)
+        if df_features is None:
+            raise KeyError(f"Feature matrix {features_key} is not in {cache_root}")
+        _features[cache_id] = df_features
+    df_features = _features[cache_id]
+
+    values = df_features.to_numpy()
+    target_column = df_features.columns.get_loc(target)
+    feature_columns = [i for i in range(values.shape[1]) if i != target_column]
+    train, test = time_series_folds(len(df_features), n_folds, gap)[fold]
+
+    def complete(rows: slice) -> Tuple[np.ndarray, np.ndarray]:
+        # only the rows of this fold are copied out of the mapped file
+        X_rows = values[rows][:, feature_columns]
+        y_rows = values[rows, target_column]
+        keep = ~np.isnan(X_rows).any(axis=1) & ~np.isnan(y_rows)
+        return X_rows[keep], y_rows[keep]
+
+    X_train, y_train = complete(train)
+    X_test, y_test = complete(test)
+    if len(y_train) == 0 or len(y_test) == 0:
+        return float("inf")
+
+    model = make_model(params)
+    model.fit(X_train, y_train)
+    return score(y_test, model.predict(X_test))
@@ -0,0 +1,288 @@
+import glob
+import os
+import re
+from collections import defaultdict
+from typing import Dict, Iterable, List, Tuple, Union
+
+import numpy as np
+import pandas as pd
+
+from utils.quality_control import BAD_QUALITY
+
+# Screening of the 900 s water-quality sonde series (dissolved oxygen,
+# ammonium, pH, turbidity, conductivity, chlorophyll and temperature) for
+# anomalies and pollution events.
+#
+# All parameters of a site are held as one (time x parameter) matrix and every
+# statistic is computed for the whole matrix at once. The detector keeps a
+# fixed amount of state per parameter (the last `window` values plus a few
+# running statistics), so the same code screens years of history in chunks or
+# a single new 15 minute reading as it arrives.
+
+SONDE_FILE_PATTERN = re.compile(r"^(?P<site>.+)_E_(?P<start>\d{6})-(?P<parameter>.+)-900\.parquet$")
+
+SCORES = ["robust_z", "ewma_z", "cusum", "anomaly"]
+
+
+def load_sonde_site(folder: str, site: str, period: int = 900,
+                    bad_quality: Iterable[str] = BAD_QUALITY) -> pd.DataFrame:
+    """
+    Load every parameter recorded by a sonde into one DataFrame.
+
+    Readings from all of a site's periodic files are combined per parameter
+    and averaged onto a regular grid of `period` seconds, as the sondes log at
+    slightly irregular times. Readings with a bad quality flag are treated as
+    missing.
+
+    Args:
+        folder: The folder containing the parquet files, e.g.
+            'datasets/River Mease'.
+        site: The site name at the start of the file names, e.g.
+            'MEASE_DS A42'.
+        period: The grid spacing in seconds.
+        bad_quality: Quality labels whose readings are masked.
+
+    Returns:
+        A Pandas DataFrame indexed by time with one column per parameter.
+    """
+    files = defaultdict(list)
+    for path in sorted(glob.glob(os.path.join(folder, f"{glob.escape(site)}_E_*-900.parquet"))):
+        match = SONDE_FILE_PATTERN.match(os.path.basename(path))
+        if match is None or match["site"] != site:
+            continue
+        readings = pd.read_parquet(path)
+        values = readings["value"].astype(float)
+        if "quality" in readings:
+            values = values.mask(readings["quality"].isin(list(bad_quality)))
+        times = pd.to_datetime(readings["dateTime"]).dt.floor(f"{period}s")
+        files[match["parameter"]].append(pd.Series(values.to_numpy(), index=times.to_numpy()))
+
+    if not files:
+        raise FileNotFoundError(f"No sonde files found for {site} in {folder}")
+
+    series = {
+        parameter: pd.concat(parts).groupby(level=0).mean()
+        for parameter, parts in files.items()
+    }
+    df_site = pd.DataFrame(series).sort_index()
+    grid = pd.date_range(df_site.index[0], df_site.index[-1], freq=f"{period}s")
+    return df_site.reindex(grid)
+
+
+class SondeAnomalyDetector:
+    """
+    Streaming anomaly detector for all parameters of one site.
+
+    Three scores are produced for every reading:
+
+    * robust_z: distance from the median of the previous `window` readings in
+      units of their scaled median absolute deviation (MAD). Picks out spikes
+      and drops.
+    * ewma_z: distance from an exponentially weighted moving average in units
+      of the exponentially weighted standard deviation. Reacts to slower
+      drifts.
+    * cusum: two-sided CUSUM of the robust z-scores. Grows while a series
+      stays away from its recent median, which marks change points such as the
+      start of a pollution event.
+
+    A reading is flagged as an anomaly when |robust_z| exceeds z_threshold or
+    cusum exceeds cusum_threshold.
+
+    Args:
+        parameters: The names of the parameters (matrix columns).
+        window: The number of previous readings used for the median and MAD.
+            96 readings is one day at 900 s.
+        alpha: The smoothing factor of the EWMA, between 0 and 1.
+        min_scale: The smallest spread used when computing z-scores, either
+            one value or one per parameter. Stops a flat series from turning
+            the smallest change into a huge score.
+        z_threshold: The |robust_z| above which a reading is an anomaly.
+        cusum_drift: The allowance k subtracted from each robust z-score
+            before it is accumulated.
+        cusum_threshold: The CUSUM score above which a reading is an anomaly.
+    """
+
+    def __init__(
+        self,
+        parameters: List[str],
+        window: int = 96,
+        alpha: float = 0.05,
+        min_scale: Union[float, np.ndarray] = 0.05,
+        z_threshold: float = 6.0,
+        cusum_drift: float = 2.0,
+        cusum_threshold: float = 50.0,
+    ):
+        self.parameters = list(parameters)
+        self.window = window
+        self.alpha = alpha
+        self.min_scale = np.broadcast_to(
+            np.asarray(min_scale, dtype=float), (len(self.parameters),)
+        )
+        self.z_threshold = z_threshold
+        self.cusum_drift = cusum_drift
+        self.cusum_threshold = cusum_threshold
+        self.reset()
+
+    def reset(self) -> None:
+        """Forget all history."""
+        n_parameters = len(self.parameters)
+        self._history = np.full((self.window, n_parameters), np.nan)
+        self._mean = np.full(n_parameters, np.nan)
+        self._var = np.full(n_parameters, np.nan)
+        self._cusum_pos = np.zeros(n_parameters)
+        self._cusum_neg = np.zeros(n_parameters)
+
+    def update(self, values: np.ndarray) -> Dict[str, np.ndarray]:
+        """
+        Score a block of new readings and advance the detector state.
+
+        Args:
+            values: An array of shape (n_readings, n_parameters), oldest
+                first. Missing readings are NaN.
+
+        Returns:
+            A dictionary mapping each name in SCORES to an array with the
+            same shape as values.
+        """
+        values = np.asarray(values, dtype=float)
+        if values.ndim == 1:
+            values = values[np.newaxis, :]
+        n = len(values)
+        if n == 0:
+            empty = np.empty((0, len(self.parameters)))
+            return {score: empty for score in SCORES}
+
+        # rolling median and MAD of the `window` readings before each one
+        history = np.concatenate([self._history, values])
+        windows = np.lib.stride_tricks.sliding_window_view(
+            history[:-1], self.window, axis=0
+        )
+        median = _nanmedian(windows)
+        mad = _nanmedian(np.abs(windows - median[..., np.newaxis]))
+        scale = np.maximum(1.4826 * mad, self.min_scale)
+        robust_z = (values - median) / scale
+
+        # EWMA mean and variance, continuing from the previous block
+        a = self.alpha
+        mean = _ewm(self._mean, values, a)
+        deviation = values - mean[:-1]
+        var = _ewm(self._var, (1 - a) * deviation ** 2, a)
+        with np.errstate(all="ignore"):
+            ewma_z = deviation / np.maximum(np.sqrt(var[:-1]), self.min_scale)
+
+        # two-sided CUSUM, solved in closed form so a block is one pass
+        increments = np.nan_to_num(np.clip(robust_z, -self.z_threshold, self.z_threshold))
+        self._cusum_pos, cusum_pos = _cusum(self._cusum_pos, increments - self.cusum_drift)
+        self._cusum_neg, cusum_neg = _cusum(self._cusum_neg, -increments - self.cusum_drift)
+        cusum = np.maximum(cusum_pos, cusum_neg)
+
+        self._history = history[-self.window:]
+        self._mean = mean[-1]
+        self._var = var[-1]
+
+        anomaly = ~np.isnan(values) & (
+            (np.abs(robust_z) > self.z_threshold) | (cusum > self.cusum_threshold)
+        )
+        return {"robust_z": robust_z, "ewma_z": ewma_z, "cusum": cusum, "anomaly": anomaly}
+
+    def update_frame(self, df_values: pd.DataFrame) -> pd.DataFrame:
+        """
+        Score new readings held in a DataFrame.
+
+        Args:
+            df_values: A Pandas DataFrame with one column per parameter,
+                such as the output of load_sonde_site.
+
+        Returns:
+            A Pandas DataFrame with the same index and (score, parameter)
+            columns.
+        """
+        scores = self.update(df_values[self.parameters].to_numpy(dtype=float))
+        return _scores_frame(scores, df_values.index, self.parameters)
+
+    def detect(self, df_values: pd.DataFrame, chunk_size: int = 4096) -> pd.DataFrame:
+        """
+        Score a whole history of readings.
+
+        The history is streamed through the detector in chunks, so the
+        results match feeding the readings one at a time and the detector is
+        left ready to carry on with new readings.
+
+        Args:
+            df_values: A Pandas DataFrame with one column per parameter.
+            chunk_size: The number of readings scored per vectorised step.
+
+        Returns:
+            A Pandas DataFrame with the same index and (score, parameter)
+            columns.
+        """
+        values = df_values[self.parameters].to_numpy(dtype=float)
+        chunks = [
+            self.update(values[start:start + chunk_size])
+            for start in range(0, len(values), chunk_size)
+        ]
+        scores = {
+            score: np.concatenate([chunk[score] for chunk in chunks])
+            if chunks else np.empty((0, len(self.parameters)))
+            for score in SCORES
+        }
+        return _scores_frame(scores, df_values.index, self.parameters)
+
+
+def pollution_events(df_scores: pd.DataFrame,
+                     min_parameters: int = 1) -> pd.Series:
+    """
+    Mark times where enough parameters are anomalous at once.
+
+    Args:
+        df_scores: The output of SondeAnomalyDetector.detect or update_frame.
+        min_parameters: How many parameters must be flagged at the same time.
+
+    Returns:
+        A boolean Pandas Series indexed by time.
+    """
+    return df_scores["anomaly"].sum(axis=1) >= min_parameters
+
+
+def _nanmedian(windows: np.ndarray) -> np.ndarray:
+    # Median over the last axis ignoring NaN. np.nanmedian falls back to a
+    # slow masked-array path for small windows; sorting moves NaN to the end
+    # so the median is read from the valid prefix of each row instead.
+    ordered = np.sort(windows, axis=-1)
+    count = np.count_nonzero(~np.isnan(ordered), axis=-1)
+    lower = np.maximum((count - 1) // 2, 0)[..., np.newaxis]
+    upper = np.maximum(count // 2, 0)[..., np.newaxis]
+    median = 0.5 * (
+        np.take_along_axis(ordered, lower, axis=-1)
+        + np.take_along_axis(ordered, upper, axis=-1)
+    )[..., 0]
+    median[count == 0] = np.nan
+    return median
+
+
+def _ewm(previous: np.ndarray, values: np.ndarray, alpha: float) -> np.ndarray:
+    # Prepending the previous state makes pandas continue the recursion
+    # y[t] = (1 - alpha) * y[t - 1] + alpha * x[t]; missing values hold y.
+    stacked = np.concatenate([previous[np.newaxis, :], values])
+    return pd.DataFrame(stacked).ewm(alpha=alpha, adjust=False, ignore_na=True).mean().to_numpy()
+
+
+def _cusum(previous: np.ndarray,
+           increments: np.ndarray) -> Tuple[np.ndarray, np.ndarray]:
+    # S[t] = max(0, S[t - 1] + x[t]) has the solution
+    # S[t] = C[t] - min(-S[0], min(C[1..t])) where C is the running sum of x.
+    running = np.cumsum(increments, axis=0)
+    lowest = np.minimum(np.minimum.accumulate(running, axis=0), -previous)
+    scores = running - lowest
+    return scores[-1], scores
+
+
+def _scores_frame(scores: Dict[str, np.ndarray], index: pd.Index,
+                  parameters: List[str]) -> pd.DataFrame:
+    df_scores = pd.concat(
+        {score: pd.DataFrame(scores[score], index=index, columns=parameters) for score in SCORES},
+        axis=1,
+    )
+    df_scores.columns.names = ["score", "parameter"]
+    return df_scores
+
@@ -0,0 +1,254 @@
+import hashlib
+import json
+import os
+import tempfile
+from typing import Any, Callable, Dict, Iterable, Optional
+
+import numpy as np
+import pandas as pd
+
+# Content-addressed cache of feature matrices built from the datasets/ files.
+#
+# A matrix is keyed by a hash of the versions of its input series, the feature
+# spec and the time range, and is stored as .npy files that are opened with
+# memory mapping. Repeated experiments, and parallel workers on the same
+# machine, share the pages of one file instead of each rebuilding or copying
+# the matrix. The cache is evicted least recently used first once it grows
+# past max_bytes.
+#
+# Each entry is three files: <key>.values.npy, <key>.index.npy and
+# <key>.json. The json file is written last and its presence marks a complete
+# entry; its modification time records the last use.
+
+DEFAULT_CACHE_DIR = os.environ.get("FEATURE_CACHE_DIR", "feature_cache")
+DEFAULT_MAX_BYTES = 10 * 1024 ** 3
+
+
+def series_version(path: str) -> str:
+    """
+    Return a version string for an input file.
+
+    The version changes whenever the file is rewritten, without reading
+    its contents.
+
+    Args:
+        path: The path to a dataset file, e.g. a parquet file in datasets/.
+
+    Returns:
+        A string made of the file's absolute path, size and modification time.
+    """
+    stat = os.stat(path)
+    return f"{os.path.abspath(path)}:{stat.st_size}:{stat.st_mtime_ns}"
+
+
+def cache_key(inputs: Iterable[str], feature_spec: Dict[str, Any],
+              start_date: Optional[str] = None,
+              end_date: Optional[str] = None) -> str:
+    """
+    Build the cache key for a feature matrix.
+
+    Args:
+        inputs: Paths of the input files, or version strings for inputs that
+            are not files. Order does not matter.
+        feature_spec: A JSON-serialisable description of the features, e.g.
+            lags and rolling windows per series.
+        start_date: Start of the time range (format: YYYY-MM-DD).
+        end_date: End of the time range (format: YYYY-MM-DD).
+
+    Returns:
+        A hex SHA-256 digest.
+    """
+    versions = sorted(
+        series_version(item) if os.path.isfile(item) else item for item in inputs
+    )
+    payload = json.dumps(
+        {"inputs": versions, "spec": feature_spec, "start": start_date, "end": end_date},
+        sort_keys=True,
+        default=str,
+    )
+    return hashlib.sha256(payload.encode("utf-8")).hexdigest()
+
+
+class FeatureCache:
+    """
+    Size-bounded cache of feature matrices stored as memory-mapped files.
+
+    Args:
+        root: The directory holding the cache. Defaults to the
+            FEATURE_CACHE_DIR environment variable, or feature_cache/.
+        max_bytes: The total size above which least recently used entries are
+            deleted.
+    """
+
+    def __init__(self, root: str = DEFAULT_CACHE_DIR,
+                 max_bytes: int = DEFAULT_MAX_BYTES):
+        self.root = root
+        self.max_bytes = max_bytes
+        os.makedirs(root, exist_ok=True)
+
+    def get_or_build(
+        self,
+        inputs: Iterable[str],
+        feature_spec: Dict[str, Any],
+        build: Callable[[], pd.DataFrame],
+        start_date: Optional[str] = None,
+        end_date: Optional[str] = None,
+    ) -> pd.DataFrame:
+        """
+        Return a cached feature matrix, building and storing it if needed.
+
+        Args:
+            inputs: Paths or version strings of the input series.
+            feature_spec: A JSON-serialisable description of the features.
+            build: A function returning the feature matrix as a numeric
+                Pandas DataFrame. Only called on a cache miss.
+            start_date: Start of the time range (format: YYYY-MM-DD).
+            end_date: End of the time range (format: YYYY-MM-DD).
+
+        Returns:
+            A read-only Pandas DataFrame backed by the memory-mapped file.
+            A matrix too large for the cache, or one removed by another
+            process before it could be mapped, is returned as built.
+        """
+        inputs = list(inputs)
+        key = cache_key(inputs, feature_spec, start_date, end_date)
+        df_features = self.load(key)
+        if df_features is not None:
+            return df_features
+
+        df_built = build()
+        if _matrix_bytes(df_built) > self.max_bytes:
+            return df_built
+        self.store(key, df_built)
+        df_features = self.load(key)
+        return df_built if df_features is None else df_features
+
+    def load(self, key: str) -> Optional[pd.DataFrame]:
+        """
+        Map a cached feature matrix into memory.
+
+        Args:
+            key: The cache key from cache_key.
+
+        Returns:
+            A read-only Pandas DataFrame that shares memory with the cache
+            file, or None if the key is not cached.
+        """
+        meta_path = self._path(key, "json")
+        try:
+            with open(meta_path) as f:
+                meta = json.load(f)
+            values = np.load(self._path(key, "values.npy"), mmap_mode="r")
+            index = np.load(self._path(key, "index.npy"), mmap_mode="r")
+        except (OSError, ValueError):
+            return None
+
+        try:
+            os.utime(meta_path)
+        except OSError:
+            pass
+
+        return pd.DataFrame(
+            values,
+            index=pd.Index(index, name=meta["index_name"]),
+            columns=meta["columns"],
+            copy=False,
+        )
+
+    def store(self, key: str, df_features: pd.DataFrame) -> None:
+        """
+        Write a feature matrix to the cache and evict old entries.
+
+        Args:
+            key: The cache key from cache_key.
+            df_features: A Pandas DataFrame with only numeric columns and a
+                numeric or datetime index.
+
+        Raises:
+            ValueError: If the matrix is larger than max_bytes.
+        """
+        size = _matrix_bytes(df_features)
+        if size > self.max_bytes:
+            raise ValueError(
+                f"Feature matrix of {size} bytes does not fit a cache of {self.max_bytes} bytes"
+            )
+        # column-major, so each feature is contiguous like a DataFrame column
+        values = np.asfortranarray(df_features.to_numpy(dtype=float))
+        index = df_features.index.to_numpy()
+        if index.dtype == object:
+            raise TypeError("Feature matrices need a numeric or datetime index")
+
+        self._write(self._path(key, "values.npy"), lambda f: np.save(f, values))
+        self._write(self._path(key, "index.npy"), lambda f: np.save(f, index))
+        meta = {
+            "columns": [str(column) for column in df_features.columns],
+            "index_name": df_features.index.name,
+        }
+        self._write(self._path(key, "json"), lambda f: f.write(json.dumps(meta).encode("utf-8")))
+        self.evict(keep=key)
+
+    def evict(self, keep: Optional[str] = None) -> None:
+        """
+        Delete least recently used entries until the cache fits max_bytes.
+
+        Args:
+            keep: A key that is never evicted, e.g. the entry just stored.
+        """
+        entries = []
+        total = 0
+        for name in os.listdir(self.root):
+            if not name.endswith(".json"):
+                continue
+            key = name[:-len(".json")]
+            try:
+                used = os.path.getmtime(self._path(key, "json"))
+                size = sum(
+                    os.path.getsize(self._path(key, suffix))
+                    for suffix in ("json", "values.npy", "index.npy")
+                )
+            except OSError:
+                continue
+            total += size
+            if key != keep:
+                entries.append((used, size, key))
+
+        for _, size, key in sorted(entries):
+            if total <= self.max_bytes:
+                break
+            self.remove(key)
+            total -= size
+
+    def remove(self, key: str) -> None:
+        """
+        Delete one entry. Processes that already mapped it keep their copy.
+
+        Args:
+            key: The cache key from cache_key.
+        """
+        # the json file goes first so the entry never looks complete while
+        # it is half deleted
+        for suffix in ("json", "values.npy", "index.npy"):
+            try:
+                os.remove(self._path(key, suffix))
+            except OSError:
+                pass
+
+    def _path(self, key: str, suffix: str) -> str:
+        return os.path.join(self.root, f"{key}.{suffix}")
+
+    def _write(self, path: str, write: Callable) -> None:
+        # write under a temporary name then rename, so readers in other
+        # processes only ever see whole files
+        fd, tmp_path = tempfile.mkstemp(dir=self.root, suffix=".tmp")
+        try:
+            with os.fdopen(fd, "wb") as f:
+                write(f)
+            os.replace(tmp_path, path)
+        except BaseException:
+            os.remove(tmp_path)
+            raise
+
+
+def _matrix_bytes(df_features: pd.DataFrame) -> int:
+    # size of the values and index files, ignoring the small .npy headers
+    return df_features.shape[0] * (df_features.shape[1] + 1) * 8
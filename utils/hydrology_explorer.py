@@ -2,6 +2,11 @@ import requests
 import pandas as pd
 import json
 
+try:
+    from utils import shared_fetch
+except ImportError:  # run as a script from inside utils/
+    import shared_fetch
+
 # API DOCS https://environment.data.gov.uk/hydrology/doc/reference#batch-api
 
 base_uri = "http://environment.data.gov.uk/"
@@ -36,7 +41,7 @@ def get_open_stations(start_date: str, end_date: str, property: str) -> pd.DataF
         pandas.DataFrame: A dataframe containing information about open
             hydrology stations.
     """
-    stations = requests.get(
+    stations = shared_fetch.get_json(
         base_uri
         + f"/hydrology/id/open/stations.json?from={start_date}&to={end_date}&observedProperty={property}&_limit=100000"
     )
@@ -45,7 +50,7 @@ def get_open_stations(start_date: str, end_date: str, property: str) -> pd.DataF
         + f"/hydrology/id/open/stations.json?from={start_date}&to={end_date}"
     )
 
-    df_stations = pd.json_normalize(stations.json()["items"])
+    df_stations = pd.json_normalize(stations["items"])
 
     return df_stations
 
@@ -87,10 +92,10 @@ def get_readings(
         requests.Response: A requests.Response object containing the readings
             between the given start and end dates for the given measure.
     """
-    readings = requests.get(
+    readings = shared_fetch.get_json(
         f"{measure_id}/readings.json?mineq-date={start_date}&max-date={end_date}&_limit=1890000"
     )
-    readings = pd.json_normalize(readings.json()["items"])
+    readings = pd.json_normalize(readings["items"])
 
     # print(
     #     f"{measure_id}/readings.json?mineq-date={start_date}&max-date={end_date}&_limit=1890000"
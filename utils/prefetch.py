@@ -0,0 +1,252 @@
+import threading
+from concurrent.futures import Future, ThreadPoolExecutor
+from datetime import date, timedelta
+from typing import Dict, List, Optional, Tuple
+
+import pandas as pd
+
+from utils import hydrology_explorer
+
+# Speculative background fetching for the station picked in the app sidebar.
+# Results land in the shared_fetch cache that hydrology_explorer reads from, so
+# a later call for the same readings returns immediately or joins the request
+# already in flight.
+#
+# One PrefetchPool is shared by the whole process (the app attaches it with
+# st.cache_resource) while each browser session owns a StationPrefetcher that
+# tracks its own queued jobs, so changing the selection in one session only
+# cancels that session's work.
+#
+# The rain gauge lookup the page waits on runs on its own executor, so it is
+# never stuck behind speculative readings requests from this or any other
+# session. Readings are only queued once that lookup has finished, as a
+# separate best-effort step that can never fail the lookup.
+
+
+class PrefetchPool:
+    """
+    Executors shared by every StationPrefetcher in the process.
+
+    Args:
+        max_workers: The maximum number of concurrent readings requests.
+        max_queued: The maximum number of readings requests queued or running
+            across all sessions. Further prefetches are dropped.
+        lookup_workers: The number of threads for rain gauge lookups.
+    """
+
+    def __init__(self, max_workers: int = 4, max_queued: int = 64,
+                 lookup_workers: int = 2):
+        self.lookups = ThreadPoolExecutor(
+            max_workers=lookup_workers, thread_name_prefix="prefetch-lookup"
+        )
+        self.readings = ThreadPoolExecutor(
+            max_workers=max_workers, thread_name_prefix="prefetch"
+        )
+        self._slots = threading.BoundedSemaphore(max_queued)
+
+    def submit_readings(self, fn, *args) -> Optional[Future]:
+        """
+        Queue a readings request if the shared queue has room.
+
+        Returns:
+            The Future of the request, or None if the queue is full.
+        """
+        if not self._slots.acquire(blocking=False):
+            return None
+        future = self.readings.submit(fn, *args)
+        # runs on completion and on cancellation alike
+        future.add_done_callback(lambda _: self._slots.release())
+        return future
+
+
+def create_pool(max_workers: int = 4, max_queued: int = 64) -> PrefetchPool:
+    """
+    Create the executors used for background prefetching.
+
+    Args:
+        max_workers: The maximum number of concurrent readings requests.
+        max_queued: The maximum number of readings requests queued across
+            all sessions.
+
+    Returns:
+        A PrefetchPool for StationPrefetcher instances to share.
+    """
+    return PrefetchPool(max_workers=max_workers, max_queued=max_queued)
+
+
+class StationPrefetcher:
+    """
+    Speculatively fetches recent readings for a station and its rain gauges.
+
+    Args:
+        pool: The PrefetchPool to run requests on.
+        max_pending: The maximum number of readings requests this session
+            queues at once. Measures beyond this are not prefetched.
+        recent_days: How many days of readings, ending today, to prefetch.
+        rainfall_distance: The distance (in metres) within which rain gauges
+            are considered neighbours of the selected station.
+    """
+
+    def __init__(
+        self,
+        pool: PrefetchPool,
+        max_pending: int = 16,
+        recent_days: int = 30,
+        rainfall_distance: float = 8000,
+    ):
+        self.pool = pool
+        self.max_pending = max_pending
+        self.recent_days = recent_days
+        self.rainfall_distance = rainfall_distance
+
+        self._lock = threading.Lock()
+        self._station: Optional[str] = None
+        self._generation = 0
+        self._rainfall: Optional[Future] = None
+        self._pending: Dict[Tuple[str, str, str], Future] = {}
+
+    def recent_window(self) -> Tuple[str, str]:
+        """
+        Return the (start_date, end_date) window that is prefetched.
+
+        Returns:
+            A tuple of dates formatted as YYYY-MM-DD.
+        """
+        end = date.today()
+        start = end - timedelta(days=self.recent_days)
+        return start.isoformat(), end.isoformat()
+
+    def select(self, stations_df: pd.DataFrame, station_label: str) -> None:
+        """
+        Start prefetching for a newly selected station.
+
+        Calling this again with the same station is a no-op, so it is safe to
+        call on every Streamlit rerun. Selecting a different station cancels
+        any work queued for the previous one.
+
+        Args:
+            stations_df: A Pandas DataFrame containing information about
+                hydrology stations, as returned by get_open_stations.
+            station_label: The label of the selected station.
+        """
+        with self._lock:
+            if station_label == self._station:
+                return
+            self._cancel_locked()
+            self._station = station_label
+            generation = self._generation
+
+        row = stations_df[stations_df["label"] == station_label].iloc[0]
+        measures = hydrology_explorer.measures_from_station(stations_df, station_label)
+
+        rainfall = self.pool.lookups.submit(
+            self._fetch_rainfall, generation, row["easting"], row["northing"]
+        )
+        with self._lock:
+            if generation == self._generation:
+                self._rainfall = rainfall
+            else:
+                rainfall.cancel()
+        rainfall.add_done_callback(
+            lambda future: self._queue_readings(generation, measures, future)
+        )
+
+    def cancel(self) -> None:
+        """Cancel all queued prefetch work and forget the selected station."""
+        with self._lock:
+            self._cancel_locked()
+            self._station = None
+
+    def get_rainfall(self, location_easting: float,
+                     location_northing: float) -> pd.DataFrame:
+        """
+        Return rain gauges near the selected station.
+
+        Waits on the background lookup started by select, falling back to a
+        synchronous call to hydrology_explorer.get_rainfall if none is running.
+
+        Args:
+            location_easting: The easting coordinate of the selected station.
+            location_northing: The northing coordinate of the selected station.
+
+        Returns:
+            A Pandas DataFrame of rain gauges within rainfall_distance.
+        """
+        with self._lock:
+            rainfall = self._rainfall
+        if rainfall is not None and not rainfall.cancelled():
+            result = rainfall.result()
+            if result is not None:
+                return result
+        return hydrology_explorer.get_rainfall(
+            location_easting, location_northing, self.rainfall_distance
+        )
+
+    def _cancel_locked(self) -> None:
+        self._generation += 1
+        for future in self._pending.values():
+            future.cancel()
+        if self._rainfall is not None:
+            self._rainfall.cancel()
+        self._pending = {}
+        self._rainfall = None
+
+    def _submit_measures(self, generation: int, measures: pd.DataFrame) -> None:
+        start_date, end_date = self.recent_window()
+        measure_ids: List[str] = measures["@id"].to_list() if "@id" in measures else []
+        with self._lock:
+            for measure_id in measure_ids:
+                if generation != self._generation:
+                    return
+                if len(self._pending) >= self.max_pending:
+                    return
+                key = (measure_id, start_date, end_date)
+                if key in self._pending:
+                    continue
+                future = self.pool.submit_readings(self._fetch_readings, generation, key)
+                if future is None:
+                    return
+                self._pending[key] = future
+
+    def _fetch_rainfall(self, generation: int, easting: float,
+                        northing: float) -> Optional[pd.DataFrame]:
+        if generation != self._generation:
+            return None
+        return hydrology_explorer.get_rainfall(easting, northing, self.rainfall_distance)
+
+    def _queue_readings(self, generation: int, measures: pd.DataFrame,
+                        rainfall: Future) -> None:
+        # Runs once the lookup's result is set, so the page is never kept
+        # waiting by this and never sees its errors. Readings for the station
+        # are queued first, then those of its rain gauges.
+        if rainfall.cancelled() or rainfall.exception() is not None:
+            return
+        rainfall_sites = rainfall.result()
+        if rainfall_sites is None:
+            return
+        try:
+            self._submit_measures(generation, measures)
+            for label in rainfall_sites["label"]:
+                if generation != self._generation:
+                    break
+                self._submit_measures(
+                    generation,
+                    hydrology_explorer.measures_from_station(rainfall_sites, label),
+                )
+        except Exception:
+            # prefetching is best effort, e.g. a catalogue row with an
+            # unexpected label or measures is simply not prefetched
+            pass
+
+    def _fetch_readings(self, generation: int,
+                        key: Tuple[str, str, str]) -> Optional[pd.DataFrame]:
+        # Jobs for a station that is no longer selected exit before touching
+        # the network, even if they were already picked up by a worker.
+        if generation != self._generation:
+            return None
+        measure_id, start_date, end_date = key
+        readings = hydrology_explorer.get_readings(start_date, end_date, measure_id)
+        with self._lock:
+            if generation == self._generation:
+                self._pending.pop(key, None)
+        return readings
@@ -0,0 +1,359 @@
+import re
+from typing import Iterable, Optional, Tuple
+
+import numpy as np
+import pandas as pd
+
+# Quality control and gap filling for readings returned by get_readings.
+#
+# Each series is cleaned in one vectorised pass: readings are snapped to the
+# regular grid given by the measure period (the -900 / -86400 part of the
+# measure id or file name), duplicates are dropped, bad quality readings are
+# masked, spike and flatline tests are applied and gaps are filled up to
+# configurable lengths. Every grid point gets a bitmask recording what was
+# done to it, using the FLAG_* values below.
+
+FLAG_MISSING = 1  # no usable reading; NaN unless a FLAG_FILLED_* bit is set
+FLAG_DUPLICATE = 2  # more than one reading fell on this grid point
+FLAG_BAD_QUALITY = 4  # masked because of the reading's quality flag
+FLAG_INCOMPLETE = 8  # completeness flag was not 'Complete'
+FLAG_SPIKE = 16  # masked by the spike test
+FLAG_FLATLINE = 32  # part of a run of identical readings
+FLAG_FILLED_LINEAR = 64
+FLAG_FILLED_REGRESSION = 128
+FLAG_FILLED_SEASONAL = 256
+
+FLAG_FILLED = FLAG_FILLED_LINEAR | FLAG_FILLED_REGRESSION | FLAG_FILLED_SEASONAL
+
+BAD_QUALITY = ("Missing", "Suspect")
+
+# Default durations (seconds) for clean_values, for sub-daily and for daily
+# series. A daily series needs limits of several days to fill anything, and
+# its season is a year rather than a day.
+DEFAULT_LIMITS = {
+    "flatline_limit": (86400, 7 * 86400),
+    "linear_limit": (3 * 3600, 3 * 86400),
+    "regression_limit": (7 * 86400, 7 * 86400),
+    "season": (86400, 365 * 86400),
+    "seasonal_limit": (86400, 31 * 86400),
+}
+
+PERIOD_PATTERN = re.compile(r"-(\d+)(?=-|\.parquet$|$)")
+
+
+def period_from_name(name: str) -> int:
+    """
+    Get the measure period in seconds from a measure id or file name.
+
+    Args:
+        name: A measure id such as '...-level-i-900-m-qualified' or a file
+            name such as 'Frome Rodden-level-86400.parquet'.
+
+    Returns:
+        The period in seconds, e.g. 900 or 86400.
+
+    Raises:
+        ValueError: If no period can be found in the name.
+    """
+    periods = [int(p) for p in PERIOD_PATTERN.findall(name) if int(p) in (900, 3600, 86400)]
+    if not periods:
+        raise ValueError(f"Cannot find a measure period in {name!r}")
+    return periods[-1]
+
+
+def clean_readings(
+    readings: pd.DataFrame,
+    period: Optional[int] = None,
+    bad_quality: Iterable[str] = BAD_QUALITY,
+    mask_incomplete: bool = False,
+    upstream: Optional[pd.Series] = None,
+    upstream_lag: int = 0,
+    **limits,
+) -> pd.DataFrame:
+    """
+    Clean a series of readings onto a regular grid.
+
+    Args:
+        readings: A Pandas DataFrame of readings as returned by get_readings
+            or stored in datasets/, with 'dateTime' (or 'date'), 'value' and
+            optionally 'quality', 'completeness' and 'measure.@id' columns.
+        period: The grid spacing in seconds. Taken from the measure id when
+            not given.
+        bad_quality: Quality labels whose readings are masked.
+        mask_incomplete: Whether to mask daily readings whose completeness
+            is not 'Complete'. They are flagged either way.
+        upstream: An optional cleaned series from a related gauge, indexed by
+            time, used for regression gap filling.
+        upstream_lag: The travel time in seconds from the upstream gauge.
+        **limits: Keyword arguments passed on to clean_values, e.g.
+            linear_limit or spike_threshold.
+
+    Returns:
+        A Pandas DataFrame indexed by time on a regular grid with a 'value'
+        column and a 'qc_flags' column of FLAG_* bits.
+    """
+    if period is None:
+        period = period_from_name(str(readings["measure.@id"].iloc[0]))
+
+    # daily statistics carry the time of the max/min in dateTime, so they
+    # are gridded by date instead
+    time_column = "date" if period == 86400 and "date" in readings else "dateTime"
+    times = pd.to_datetime(readings[time_column]).to_numpy(dtype="datetime64[s]").astype(np.int64)
+    values = readings["value"].to_numpy(dtype=float)
+
+    bad = np.zeros(len(readings), dtype=bool)
+    if "quality" in readings:
+        bad = readings["quality"].isin(list(bad_quality)).to_numpy()
+    incomplete = np.zeros(len(readings), dtype=bool)
+    if "completeness" in readings:
+        incomplete = readings["completeness"].notna().to_numpy() & (
+            readings["completeness"] != "Complete"
+        ).to_numpy()
+
+    upstream_values = None
+    if upstream is not None:
+        upstream_times = upstream.index.to_numpy(dtype="datetime64[s]").astype(np.int64)
+        upstream_values = (upstream_times + upstream_lag, upstream.to_numpy(dtype=float))
+
+    grid, cleaned, flags = clean_values(
+        times, values, period,
+        bad=bad, incomplete=incomplete, mask_incomplete=mask_incomplete,
+        upstream=upstream_values, **limits,
+    )
+    index = pd.DatetimeIndex(grid.astype("datetime64[s]"), name="dateTime")
+    return pd.DataFrame({"value": cleaned, "qc_flags": flags}, index=index)
+
+
+def clean_values(
+    times: np.ndarray,
+    values: np.ndarray,
+    period: int,
+    bad: Optional[np.ndarray] = None,
+    incomplete: Optional[np.ndarray] = None,
+    mask_incomplete: bool = False,
+    upstream: Optional[Tuple[np.ndarray, np.ndarray]] = None,
+    spike_threshold: Optional[float] = None,
+    flatline_limit: Optional[int] = None,
+    mask_flatline: bool = False,
+    linear_limit: Optional[int] = None,
+    regression_limit: Optional[int] = None,
+    season: Optional[int] = None,
+    seasonal_limit: Optional[int] = None,
+) -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
+    """
+    Clean a series held in NumPy arrays.
+
+    This is the vectorised core of clean_readings. All durations are in
+    seconds and are rounded down to whole periods; a limit of 0 turns the
+    step off. Durations left as None take the sub-daily or daily value from
+    DEFAULT_LIMITS depending on period. Seasonal filling is skipped when the
+    season is shorter than two periods.
+
+    Args:
+        times: Reading times as integer seconds since the epoch.
+        values: Reading values.
+        period: The grid spacing in seconds.
+        bad: True for readings with a bad quality flag.
+        incomplete: True for readings that are not complete.
+        mask_incomplete: Whether to mask incomplete readings.
+        upstream: An optional (times, values) pair from a related gauge,
+            with times already shifted by the travel time.
+        spike_threshold: How far (in the series' units) a reading must stand
+            out from both neighbours to be a spike. Defaults to ten times the
+            95th percentile of the absolute step between readings.
+        flatline_limit: The shortest run of identical readings flagged as a
+            flatline.
+        mask_flatline: Whether to mask flatlined readings.
+        linear_limit: The longest gap filled by linear interpolation.
+        regression_limit: The longest gap filled by regression on upstream.
+        season: The seasonal period used for seasonal filling.
+        seasonal_limit: The longest gap filled from the previous season.
+
+    Returns:
+        A tuple of (grid times in seconds since the epoch, cleaned values,
+        uint16 flags).
+    """
+    daily = int(period >= 86400)
+    defaults = {name: limits[daily] for name, limits in DEFAULT_LIMITS.items()}
+    flatline_limit = defaults["flatline_limit"] if flatline_limit is None else flatline_limit
+    linear_limit = defaults["linear_limit"] if linear_limit is None else linear_limit
+    regression_limit = defaults["regression_limit"] if regression_limit is None else regression_limit
+    season = defaults["season"] if season is None else season
+    seasonal_limit = defaults["seasonal_limit"] if seasonal_limit is None else seasonal_limit
+
+    times = np.asarray(times, dtype=np.int64)
+    values = np.asarray(values, dtype=float)
+    if len(times) == 0:
+        return times, values, np.zeros(0, dtype=np.uint16)
+
+    bad = np.zeros(len(times), dtype=bool) if bad is None else np.asarray(bad, dtype=bool)
+    incomplete = (
+        np.zeros(len(times), dtype=bool) if incomplete is None
+        else np.asarray(incomplete, dtype=bool)
+    )
+    if not np.all(times[1:] >= times[:-1]):
+        order = np.argsort(times, kind="stable")
+        times, values, bad, incomplete = times[order], values[order], bad[order], incomplete[order]
+
+    # snap to the grid and keep the last reading for each grid point
+    slots = times // period
+    start = slots[0]
+    n = int(slots[-1] - start + 1)
+    grid = (start + np.arange(n, dtype=np.int64)) * period
+    flags = np.zeros(n, dtype=np.uint16)
+
+    boundary = slots[1:] != slots[:-1]
+    if n == len(slots) and boundary.all():
+        # already one reading per grid point, nothing to move
+        value = values.copy()
+        is_bad, is_incomplete = bad, incomplete
+    else:
+        last = np.append(boundary, True)
+        duplicate = ~np.insert(boundary, 0, True)[last]
+        position = slots[last] - start
+        value = np.full(n, np.nan)
+        value[position] = values[last]
+        is_bad = np.zeros(n, dtype=bool)
+        is_bad[position] = bad[last]
+        is_incomplete = np.zeros(n, dtype=bool)
+        is_incomplete[position] = incomplete[last]
+        flags[position[duplicate]] |= FLAG_DUPLICATE
+
+    _flag(flags, is_bad, FLAG_BAD_QUALITY)
+    _flag(flags, is_incomplete, FLAG_INCOMPLETE)
+    value[is_bad | (is_incomplete & mask_incomplete)] = np.nan
+
+    spike = _spikes(value, spike_threshold)
+    _flag(flags, spike, FLAG_SPIKE)
+    value[spike] = np.nan
+
+    flatline_length = flatline_limit // period
+    if flatline_length > 1:
+        flat = _flatlines(value, flatline_length)
+        _flag(flags, flat, FLAG_FLATLINE)
+        if mask_flatline:
+            value[flat] = np.nan
+
+    missing = np.isnan(value)
+    _flag(flags, missing, FLAG_MISSING)
+
+    filled = _fill_linear(value, linear_limit // period)
+    _flag(flags, filled, FLAG_FILLED_LINEAR)
+
+    if upstream is not None and regression_limit // period > 0:
+        upstream_value = _on_grid(upstream[0], upstream[1], grid, period)
+        filled = _fill_regression(value, upstream_value, regression_limit // period)
+        _flag(flags, filled, FLAG_FILLED_REGRESSION)
+
+    # a season of one period would just copy the previous reading
+    if season // period >= 2 and seasonal_limit // period > 0:
+        filled = _fill_seasonal(value, season // period, seasonal_limit // period)
+        _flag(flags, filled, FLAG_FILLED_SEASONAL)
+
+    return grid, value, flags
+
+
+def _flag(flags: np.ndarray, where: np.ndarray, flag: int) -> None:
+    np.bitwise_or(flags, np.uint16(flag), out=flags, where=where)
+
+
+def _spikes(value: np.ndarray, threshold: Optional[float]) -> np.ndarray:
+    # A reading is a spike when it stands out from both neighbours by more
+    # than the threshold: |x - (prev + next) / 2| - |next - prev| / 2.
+    spike = np.zeros(len(value), dtype=bool)
+    if len(value) < 3:
+        return spike
+    previous, current, following = value[:-2], value[1:-1], value[2:]
+    if threshold is None:
+        # a strided sample of steps between neighbouring readings is plenty
+        # to estimate the percentile
+        stride = max(len(value) // 100000, 1)
+        steps = np.abs(value[1::stride] - value[:-1:stride])
+        if np.all(np.isnan(steps)):
+            return spike
+        threshold = 10 * np.nanpercentile(steps, 95)
+        if threshold == 0:
+            return spike
+    with np.errstate(invalid="ignore"):
+        test = np.abs(current - 0.5 * (previous + following)) - 0.5 * np.abs(following - previous)
+        spike[1:-1] = test > threshold
+    return spike
+
+
+def _runs(is_run: np.ndarray) -> Tuple[np.ndarray, np.ndarray]:
+    # Start and end (exclusive) of each run of True values.
+    edges = np.diff(is_run.view(np.int8), prepend=np.int8(0), append=np.int8(0))
+    return np.flatnonzero(edges == 1), np.flatnonzero(edges == -1)
+
+
+def _runs_mask(starts: np.ndarray, ends: np.ndarray, n: int) -> np.ndarray:
+    marker = np.zeros(n + 1, dtype=np.int8)
+    marker[starts] = 1
+    marker[ends] -= 1
+    return np.cumsum(marker[:-1], dtype=np.int8).view(bool)
+
+
+def _flatlines(value: np.ndarray, length: int) -> np.ndarray:
+    # runs of readings equal to the one before; NaN never compares equal
+    same = np.zeros(len(value), dtype=bool)
+    same[1:] = value[1:] == value[:-1]
+    starts, ends = _runs(same)
+    # each run also includes the reading before its first repeat
+    long = ends - starts + 1 >= length
+    return _runs_mask(starts[long] - 1, ends[long], len(value))
+
+
+def _gaps(value: np.ndarray, limit: int) -> np.ndarray:
+    # True inside gaps no longer than `limit` that have a reading either side.
+    if limit <= 0:
+        return np.zeros(len(value), dtype=bool)
+    starts, ends = _runs(np.isnan(value))
+    keep = (starts > 0) & (ends < len(value)) & (ends - starts <= limit)
+    return _runs_mask(starts[keep], ends[keep], len(value))
+
+
+def _fill_linear(value: np.ndarray, limit: int) -> np.ndarray:
+    gaps = _gaps(value, limit)
+    if gaps.any():
+        valid = np.flatnonzero(~np.isnan(value))
+        value[gaps] = np.interp(np.flatnonzero(gaps), valid, value[valid])
+    return gaps
+
+
+def _fill_regression(value: np.ndarray, upstream: np.ndarray, limit: int) -> np.ndarray:
+    # least squares fit of value = a + b * upstream over shared readings
+    both = ~np.isnan(value) & ~np.isnan(upstream)
+    gaps = _gaps(value, limit) & ~np.isnan(upstream)
+    if both.sum() < 2 or not gaps.any():
+        return np.zeros(len(value), dtype=bool)
+    slope, intercept = np.polyfit(upstream[both], value[both], 1)
+    value[gaps] = intercept + slope * upstream[gaps]
+    return gaps
+
+
+def _fill_seasonal(value: np.ndarray, season: int, limit: int) -> np.ndarray:
+    # Copy the reading one season earlier, shifted by an offset interpolated
+    # between the gap edges so the filled section joins up with the series.
+    if len(value) <= season:
+        return np.zeros(len(value), dtype=bool)
+    previous = np.full(len(value), np.nan)
+    previous[season:] = value[:-season]
+    offset = value - previous
+    known = np.flatnonzero(~np.isnan(offset))
+    gaps = _gaps(value, limit) & ~np.isnan(previous)
+    if len(known) == 0 or not gaps.any():
+        return np.zeros(len(value), dtype=bool)
+    where = np.flatnonzero(gaps)
+    value[gaps] = previous[gaps] + np.interp(where, known, offset[known])
+    return gaps
+
+
+def _on_grid(times: np.ndarray, values: np.ndarray, grid: np.ndarray,
+             period: int) -> np.ndarray:
+    # Values of another series at each grid point, NaN where it has none.
+    slots = np.asarray(times, dtype=np.int64) // period
+    position = np.searchsorted(grid // period, slots)
+    inside = (position < len(grid)) & (grid[np.minimum(position, len(grid) - 1)] // period == slots)
+    on_grid = np.full(len(grid), np.nan)
+    on_grid[position[inside]] = np.asarray(values, dtype=float)[inside]
+    return on_grid
@@ -0,0 +1,422 @@
+import bisect
+import os
+from collections import defaultdict
+from typing import Any, Dict, List, Optional, Tuple
+
+import numpy as np
+import pandas as pd
+
+# Directed network of river gauges built from the station catalogue returned
+# by get_open_stations.
+#
+# Gauges a few metres apart or listed as colocatedStation are merged into one
+# site. Sites with the same riverName are split into separate reaches when
+# they are far apart (there are several River Avons), and each reach is
+# ordered from upstream to downstream by catchmentArea. Where a gauge has no
+# catchment area it is estimated from the gauge's position along the reach.
+# The most downstream site of a reach joins the nearest site on another reach
+# with a larger catchment, which links tributaries to their main river.
+#
+# Distances are straight lines between consecutive sites, so they are a lower
+# bound on the distance along the channel. Travel times assume a constant wave
+# celerity.
+#
+# Matching gauges into sites and reaches is the slow part, so a built network
+# can be saved and loaded. Every upstream relationship is precomputed when a
+# network is created, so queries are dictionary lookups.
+
+DEFAULT_CELERITY = 1.0  # metres per second
+
+
+class RiverNetwork:
+    """
+    Upstream/downstream relationships between river gauges.
+
+    Use RiverNetwork.from_catalogue to build a network and RiverNetwork.load
+    to read one written with save.
+
+    Args:
+        stations: A Pandas DataFrame with one row per station and columns
+            'station', 'label', 'site', 'riverName', 'easting', 'northing'
+            and 'catchmentArea'.
+        edges: A Pandas DataFrame of links between sites with columns
+            'site', 'downstream_site' and 'distance_km'.
+        celerity: The wave speed in metres per second used for travel times.
+    """
+
+    def __init__(self, stations: pd.DataFrame, edges: pd.DataFrame,
+                 celerity: float = DEFAULT_CELERITY):
+        self.stations = stations.reset_index(drop=True)
+        self.edges = edges.reset_index(drop=True)
+        self.celerity = celerity
+
+        self._site_of: Dict[str, int] = dict(zip(self.stations["station"], self.stations["site"]))
+        self._stations_at: Dict[int, List[str]] = defaultdict(list)
+        for station, site in zip(self.stations["station"], self.stations["site"]):
+            self._stations_at[site].append(station)
+
+        self._downstream: Dict[int, Tuple[int, float]] = {
+            site: (downstream, distance)
+            for site, downstream, distance in zip(
+                self.edges["site"], self.edges["downstream_site"], self.edges["distance_km"]
+            )
+        }
+
+        # upstream closure: for every site, the sites upstream of it and
+        # their distance, sorted by distance for range queries
+        upstream: Dict[int, List[Tuple[float, int]]] = defaultdict(list)
+        self._distance: Dict[Tuple[int, int], float] = {}
+        for site in self._stations_at:
+            total = 0.0
+            current = site
+            seen = {site}
+            while current in self._downstream:
+                current, distance = self._downstream[current]
+                if current in seen:  # guard against a malformed cycle
+                    break
+                seen.add(current)
+                total += distance
+                upstream[current].append((total, site))
+                self._distance[(site, current)] = total
+        self._upstream = {site: sorted(pairs) for site, pairs in upstream.items()}
+        self._upstream_km = {
+            site: [distance for distance, _ in pairs] for site, pairs in self._upstream.items()
+        }
+
+    @classmethod
+    def from_catalogue(
+        cls,
+        stations_df: pd.DataFrame,
+        merge_distance: float = 100,
+        reach_distance: float = 30000,
+        junction_distance: float = 15000,
+        celerity: float = DEFAULT_CELERITY,
+    ) -> "RiverNetwork":
+        """
+        Build the network from the station catalogue.
+
+        Args:
+            stations_df: A Pandas DataFrame of stations as returned by
+                get_open_stations (the '@id' column may be renamed 'id').
+                Stations without a riverName or coordinates are left out, and
+                querying them raises KeyError.
+            merge_distance: Gauges on the same river closer than this (in
+                metres) are treated as one site.
+            reach_distance: Gauges on rivers with the same name further than
+                this (in metres) from every other gauge of that name are put
+                on separate reaches.
+            junction_distance: The furthest (in metres) a reach's last gauge
+                may be from the gauge it drains to on another reach.
+            celerity: The wave speed in metres per second used for travel
+                times.
+
+        Returns:
+            A RiverNetwork.
+        """
+        id_column = "@id" if "@id" in stations_df else "id"
+        df = pd.DataFrame({
+            "station": stations_df[id_column],
+            "label": stations_df["label"].map(_first),
+            "riverName": stations_df["riverName"].map(_first),
+            "easting": pd.to_numeric(stations_df["easting"].map(_first), errors="coerce"),
+            "northing": pd.to_numeric(stations_df["northing"].map(_first), errors="coerce"),
+            "catchmentArea": pd.to_numeric(stations_df["catchmentArea"].map(_first), errors="coerce"),
+        })
+        colocated = _colocated_column(stations_df)
+        keep = (
+            df["riverName"].map(lambda name: isinstance(name, str) and name.strip() != "")
+            & df["easting"].notna() & df["northing"].notna()
+        ).to_numpy()
+        df = df[keep].reset_index(drop=True)
+        colocated = colocated[keep].reset_index(drop=True)
+        df["river"] = df["riverName"].str.strip().str.lower()
+
+        df["site"] = _sites(df, colocated, merge_distance)
+        sites = df.groupby("site").agg(
+            river=("river", "first"),
+            easting=("easting", "mean"),
+            northing=("northing", "mean"),
+            catchmentArea=("catchmentArea", "max"),
+        )
+        sites["reach"] = _reaches(sites, reach_distance)
+        sites["area"] = _estimated_areas(sites)
+
+        edges = _reach_edges(sites) + _junction_edges(sites, junction_distance)
+        df_edges = pd.DataFrame(edges, columns=["site", "downstream_site", "distance_km"])
+        df_stations = df[["station", "label", "site", "riverName", "easting",
+                          "northing", "catchmentArea"]]
+        return cls(df_stations, df_edges, celerity)
+
+    @classmethod
+    def load(cls, path: str, celerity: float = DEFAULT_CELERITY) -> "RiverNetwork":
+        """
+        Read a network written by save.
+
+        Args:
+            path: The directory the network was saved to.
+            celerity: The wave speed in metres per second used for travel
+                times.
+
+        Returns:
+            A RiverNetwork.
+        """
+        return cls(
+            pd.read_parquet(os.path.join(path, "stations.parquet")),
+            pd.read_parquet(os.path.join(path, "edges.parquet")),
+            celerity,
+        )
+
+    def save(self, path: str) -> None:
+        """
+        Write the network to a directory of parquet files.
+
+        Args:
+            path: The directory to write to. It is created if needed.
+        """
+        os.makedirs(path, exist_ok=True)
+        self.stations.to_parquet(os.path.join(path, "stations.parquet"), index=False)
+        self.edges.to_parquet(os.path.join(path, "edges.parquet"), index=False)
+
+    def upstream(self, station: str, max_km: Optional[float] = None) -> pd.DataFrame:
+        """
+        List the gauges upstream of a station.
+
+        Args:
+            station: The station id ('@id' in the catalogue).
+            max_km: Only include gauges within this distance.
+
+        Returns:
+            A Pandas DataFrame with columns 'station', 'distance_km' and
+            'lag_hours', nearest first. Gauges at the same site are included
+            with a distance of 0.
+
+        Raises:
+            KeyError: If the station is not in the network, e.g. because it
+                has no riverName or coordinates in the catalogue.
+        """
+        site = self._site_of[station]
+        pairs = self._upstream.get(site, [])
+        if max_km is not None:
+            pairs = pairs[:bisect.bisect_right(self._upstream_km.get(site, []), max_km)]
+        rows = [
+            (other, 0.0) for other in self._stations_at[site] if other != station
+        ] + [
+            (other, distance) for distance, upstream_site in pairs
+            for other in self._stations_at[upstream_site]
+        ]
+        df_upstream = pd.DataFrame(rows, columns=["station", "distance_km"])
+        df_upstream["lag_hours"] = df_upstream["distance_km"].map(self._hours)
+        return df_upstream
+
+    def downstream(self, station: str) -> Optional[str]:
+        """
+        Return the site directly downstream of a station.
+
+        Args:
+            station: The station id.
+
+        Returns:
+            The id of a station at the next site downstream, or None if the
+            station is the last on its river.
+
+        Raises:
+            KeyError: If the station is not in the network.
+        """
+        link = self._downstream.get(self._site_of[station])
+        return None if link is None else self._stations_at[link[0]][0]
+
+    def distance_km(self, upstream_station: str, station: str) -> Optional[float]:
+        """
+        Return the distance from one station down to another.
+
+        Args:
+            upstream_station: The id of the upstream station.
+            station: The id of the downstream station.
+
+        Returns:
+            The distance in kilometres, or None if upstream_station is not
+            upstream of station.
+
+        Raises:
+            KeyError: If either station is not in the network.
+        """
+        upstream_site = self._site_of[upstream_station]
+        site = self._site_of[station]
+        if upstream_site == site:
+            return 0.0
+        return self._distance.get((upstream_site, site))
+
+    def lag_hours(self, upstream_station: str, station: str) -> Optional[float]:
+        """
+        Return the travel time from one station down to another.
+
+        Args:
+            upstream_station: The id of the upstream station.
+            station: The id of the downstream station.
+
+        Returns:
+            The travel time in hours, or None if upstream_station is not
+            upstream of station.
+
+        Raises:
+            KeyError: If either station is not in the network.
+        """
+        distance = self.distance_km(upstream_station, station)
+        return None if distance is None else self._hours(distance)
+
+    def _hours(self, distance_km: float) -> float:
+        return distance_km * 1000 / self.celerity / 3600
+
+
+def _first(value: Any) -> Any:
+    # The API returns some fields as lists when a station has several
+    # values; flattened copies of the catalogue join them with '|'.
+    if isinstance(value, (list, np.ndarray)):
+        return value[0] if len(value) else None
+    if isinstance(value, str) and "|" in value:
+        return value.split("|")[0]
+    return value
+
+
+def _colocated_column(stations_df: pd.DataFrame) -> pd.Series:
+    # The ids of each station's colocated stations. The API gives
+    # colocatedStation as one {"@id": ...} object or a list of them;
+    # json_normalize flattens single objects into a 'colocatedStation.@id'
+    # column and leaves lists as they are, and flattened copies of the
+    # catalogue join the ids with '|'.
+    columns = [
+        column for column in ("colocatedStation", "colocatedStation.@id", "colocatedStation.id")
+        if column in stations_df
+    ]
+    return pd.Series(
+        [
+            [other for column in columns for other in _colocated_ids(row[column])]
+            for _, row in stations_df[columns].iterrows()
+        ],
+        index=stations_df.index,
+        dtype=object,
+    )
+
+
+def _colocated_ids(value: Any) -> List[str]:
+    if isinstance(value, str):
+        return [item for item in value.split("|") if item]
+    if isinstance(value, dict):
+        value = value.get("@id", value.get("id"))
+        return [value] if isinstance(value, str) else []
+    if isinstance(value, (list, np.ndarray)):
+        return [other for item in value for other in _colocated_ids(item)]
+    return []
+
+
+def _sites(df: pd.DataFrame, colocated: pd.Series, merge_distance: float) -> np.ndarray:
+    # Union-find over stations that are colocated or on the same river and
+    # within merge_distance of each other.
+    parent = list(range(len(df)))
+
+    def find(i: int) -> int:
+        while parent[i] != i:
+            parent[i] = parent[parent[i]]
+            i = parent[i]
+        return i
+
+    def union(i: int, j: int) -> None:
+        parent[find(i)] = find(j)
+
+    row_of = {station: i for i, station in enumerate(df["station"])}
+    for i, value in enumerate(colocated):
+        for other in _colocated_ids(value):
+            if other in row_of:
+                union(i, row_of[other])
+
+    for rows in df.groupby("river").indices.values():
+        xy = df[["easting", "northing"]].to_numpy()[rows]
+        close = _pairwise(xy) <= merge_distance
+        for a, b in zip(*np.nonzero(np.triu(close, 1))):
+            union(rows[a], rows[b])
+
+    return np.array([find(i) for i in range(len(df))])
+
+
+def _reaches(sites: pd.DataFrame, reach_distance: float) -> pd.Series:
+    # Single-linkage clusters of same-named sites: two sites are on the same
+    # reach when a chain of sites no more than reach_distance apart joins them.
+    reach = pd.Series(-1, index=sites.index)
+    next_reach = 0
+    for _, group in sites.groupby("river"):
+        xy = group[["easting", "northing"]].to_numpy()
+        linked = _pairwise(xy) <= reach_distance
+        labels = np.full(len(group), -1)
+        for start in range(len(group)):
+            if labels[start] >= 0:
+                continue
+            stack = [start]
+            labels[start] = next_reach
+            while stack:
+                i = stack.pop()
+                for j in np.flatnonzero(linked[i] & (labels < 0)):
+                    labels[j] = next_reach
+                    stack.append(j)
+            next_reach += 1
+        reach[group.index] = labels
+    return reach
+
+
+def _estimated_areas(sites: pd.DataFrame) -> pd.Series:
+    # Catchment area where known, otherwise interpolated from the site's
+    # position along the reach's main axis. Reaches with fewer than two known
+    # areas have no direction and are left as NaN.
+    area = sites["catchmentArea"].copy()
+    for _, group in sites.groupby("reach"):
+        known = group["catchmentArea"].notna()
+        if known.sum() < 2 or known.all():
+            continue
+        position = _along_axis(group[["easting", "northing"]].to_numpy())
+        order = np.argsort(position[known.to_numpy()])
+        area[group.index[~known]] = np.interp(
+            position[~known.to_numpy()],
+            position[known.to_numpy()][order],
+            group["catchmentArea"][known].to_numpy()[order],
+        )
+    return area
+
+
+def _reach_edges(sites: pd.DataFrame) -> List[Tuple[int, int, float]]:
+    edges = []
+    for _, group in sites.groupby("reach"):
+        group = group[group["area"].notna()].sort_values("area")
+        xy = group[["easting", "northing"]].to_numpy()
+        distances = np.hypot(*(xy[1:] - xy[:-1]).T) / 1000
+        edges += list(zip(group.index[:-1], group.index[1:], distances))
+    return edges
+
+
+def _junction_edges(sites: pd.DataFrame,
+                    junction_distance: float) -> List[Tuple[int, int, float]]:
+    edges = []
+    placed = sites[sites["area"].notna()]
+    xy = placed[["easting", "northing"]].to_numpy()
+    for _, group in placed.groupby("reach"):
+        outlet = group["area"].idxmax()
+        outlet_xy = placed.loc[outlet, ["easting", "northing"]].to_numpy(dtype=float)
+        distance = np.hypot(*(xy - outlet_xy).T)
+        candidates = (
+            (placed["reach"] != placed.loc[outlet, "reach"]).to_numpy()
+            & (placed["area"] > placed.loc[outlet, "area"]).to_numpy()
+            & (distance <= junction_distance)
+        )
+        if candidates.any():
+            nearest = np.flatnonzero(candidates)[np.argmin(distance[candidates])]
+            edges.append((outlet, placed.index[nearest], distance[nearest] / 1000))
+    return edges
+
+
+def _pairwise(xy: np.ndarray) -> np.ndarray:
+    return np.hypot(*(xy[:, np.newaxis, :] - xy[np.newaxis, :, :]).transpose(2, 0, 1))
+
+
+def _along_axis(xy: np.ndarray) -> np.ndarray:
+    # projection onto the first principal axis
+    centred = xy - xy.mean(axis=0)
+    _, _, axes = np.linalg.svd(centred, full_matrices=False)
+    return centred @ axes[0]
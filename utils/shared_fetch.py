@@ -0,0 +1,251 @@
+import hashlib
+import json
+import os
+import tempfile
+import threading
+import time
+from collections import OrderedDict
+from concurrent.futures import Future
+from typing import Any, Dict, Optional, Tuple
+
+import requests
+
+# Process-wide fetch layer used by hydrology_explorer.
+#
+# Every Streamlit session runs in the same process, so identical requests made
+# by several users at once are collapsed into a single call to the API
+# (single-flight) and the raw response body is kept in a shared, size-bounded
+# LRU cache. Bodies are decoded on every call: the decoded objects are several
+# times larger than the JSON text, so caching them would leave the memory
+# limit meaningless. An optional on-disk cache lets several app worker
+# processes share responses; files are written to a temporary name and renamed
+# into place so readers never see a partial file, and old files are pruned by
+# age and total size.
+
+DEFAULT_TTL = 3600  # seconds
+DEFAULT_MAX_BYTES = 512 * 1024 * 1024
+DEFAULT_DISK_MAX_BYTES = 4 * 1024 ** 3
+PRUNE_INTERVAL = 600  # seconds between sweeps of the disk cache
+
+_lock = threading.Lock()
+_in_flight: Dict[str, Future] = {}
+_cache: "OrderedDict[str, Tuple[float, bytes]]" = OrderedDict()
+_cache_bytes = 0
+_last_prune = 0.0
+
+_settings = {
+    "ttl": DEFAULT_TTL,
+    "max_bytes": DEFAULT_MAX_BYTES,
+    "cache_dir": os.environ.get("HYDROLOGY_CACHE_DIR"),
+    "disk_max_bytes": DEFAULT_DISK_MAX_BYTES,
+}
+
+
+def configure(ttl: Optional[float] = None,
+              max_bytes: Optional[int] = None,
+              cache_dir: Optional[str] = None,
+              disk_max_bytes: Optional[int] = None) -> None:
+    """
+    Change the settings of the shared cache.
+
+    Args:
+        ttl: How long (in seconds) a response is reused before being fetched
+            again.
+        max_bytes: The maximum total size of responses held in memory.
+        cache_dir: A directory for the on-disk cache shared between processes.
+            Defaults to the HYDROLOGY_CACHE_DIR environment variable; when
+            neither is set only the in-memory cache is used.
+        disk_max_bytes: The total size above which the oldest files in
+            cache_dir are deleted.
+    """
+    with _lock:
+        if ttl is not None:
+            _settings["ttl"] = ttl
+        if max_bytes is not None:
+            _settings["max_bytes"] = max_bytes
+            _evict_locked()
+        if cache_dir is not None:
+            os.makedirs(cache_dir, exist_ok=True)
+            _settings["cache_dir"] = cache_dir
+        if disk_max_bytes is not None:
+            _settings["disk_max_bytes"] = disk_max_bytes
+
+
+def clear() -> None:
+    """Empty the in-memory cache. Requests already in flight are unaffected."""
+    global _cache_bytes
+    with _lock:
+        _cache.clear()
+        _cache_bytes = 0
+
+
+def get_json(url: str) -> Any:
+    """
+    Fetch a URL from the API and return the decoded JSON body.
+
+    Concurrent calls for the same URL share one request, and the result is
+    reused from the shared cache until it is older than the configured ttl.
+
+    Args:
+        url: The URL to fetch.
+
+    Returns:
+        The decoded JSON body of the response.
+
+    Raises:
+        requests.HTTPError: If the API returns an error status.
+    """
+    while True:
+        with _lock:
+            cached = _cache.get(url)
+            if cached is not None and time.time() - cached[0] < _settings["ttl"]:
+                _cache.move_to_end(url)
+                return json.loads(cached[1])
+            future = _in_flight.get(url)
+            leader = future is None
+            if leader:
+                future = Future()
+                _in_flight[url] = future
+
+        if not leader:
+            try:
+                return json.loads(future.result())
+            except requests.ConnectionError:
+                # the leader's request failed before reaching the API, try
+                # again rather than failing every waiting session
+                continue
+
+        try:
+            content = _fetch(url)
+        except BaseException as error:
+            future.set_exception(error)
+            raise
+        else:
+            future.set_result(content)
+            return json.loads(content)
+        finally:
+            with _lock:
+                _in_flight.pop(url, None)
+
+
+def _fetch(url: str) -> bytes:
+    cache_path = _disk_path(url)
+    cached = _read_disk(cache_path) if cache_path else None
+
+    if cached is not None:
+        # keep the file's age so the response still expires ttl after it
+        # was fetched, not ttl after it was read from disk
+        fetched, content = cached
+    else:
+        response = requests.get(url)
+        response.raise_for_status()
+        fetched, content = time.time(), response.content
+        if cache_path:
+            _write_disk(cache_path, content)
+
+    _store(url, content, fetched)
+    return content
+
+
+def _store(url: str, content: bytes, fetched: float) -> None:
+    global _cache_bytes
+    with _lock:
+        if url in _cache:
+            _cache_bytes -= len(_cache.pop(url)[1])
+        if len(content) > _settings["max_bytes"]:
+            return
+        _cache[url] = (fetched, content)
+        _cache_bytes += len(content)
+        _evict_locked()
+
+
+def _evict_locked() -> None:
+    global _cache_bytes
+    while _cache_bytes > _settings["max_bytes"] and _cache:
+        _, (_, content) = _cache.popitem(last=False)
+        _cache_bytes -= len(content)
+
+
+def _disk_path(url: str) -> Optional[str]:
+    cache_dir = _settings["cache_dir"]
+    if not cache_dir:
+        return None
+    digest = hashlib.sha256(url.encode("utf-8")).hexdigest()
+    return os.path.join(cache_dir, f"{digest}.json")
+
+
+def _read_disk(path: str) -> Optional[Tuple[float, bytes]]:
+    try:
+        fetched = os.path.getmtime(path)
+        if time.time() - fetched >= _settings["ttl"]:
+            return None
+        with open(path, "rb") as f:
+            return fetched, f.read()
+    except OSError:
+        return None
+
+
+def _write_disk(path: str, content: bytes) -> None:
+    directory = os.path.dirname(path)
+    try:
+        os.makedirs(directory, exist_ok=True)
+        fd, tmp_path = tempfile.mkstemp(dir=directory, suffix=".tmp")
+        with os.fdopen(fd, "wb") as f:
+            f.write(content)
+        os.replace(tmp_path, path)
+    except OSError:
+        # the disk cache is best effort, the response is still returned
+        pass
+
+    global _last_prune
+    with _lock:
+        due = time.time() - _last_prune >= PRUNE_INTERVAL
+        if due:
+            _last_prune = time.time()
+    if due:
+        try:
+            prune_disk()
+        except OSError:
+            # e.g. the directory was removed by another process; the sweep
+            # must not fail a fetch that has already succeeded
+            pass
+
+
+def prune_disk() -> None:
+    """
+    Delete expired files from the disk cache and trim it to disk_max_bytes.
+
+    Files are removed oldest first. Called every PRUNE_INTERVAL seconds while
+    responses are being written; safe to run from several processes at once.
+    """
+    cache_dir = _settings["cache_dir"]
+    if not cache_dir:
+        return
+    now = time.time()
+    files = []
+    for entry in os.scandir(cache_dir):
+        try:
+            stat = entry.stat()
+        except OSError:
+            continue
+        expired = now - stat.st_mtime >= _settings["ttl"]
+        # leftovers from writers that died before renaming into place
+        abandoned = entry.name.endswith(".tmp") and now - stat.st_mtime >= PRUNE_INTERVAL
+        if expired or abandoned:
+            _remove(entry.path)
+        elif entry.name.endswith(".json"):
+            files.append((stat.st_mtime, stat.st_size, entry.path))
+
+    total = sum(size for _, size, _ in files)
+    for _, size, path in sorted(files):
+        if total <= _settings["disk_max_bytes"]:
+            break
+        _remove(path)
+        total -= size
+
+
+def _remove(path: str) -> None:
+    try:
+        os.remove(path)
+    except OSError:
+        pass